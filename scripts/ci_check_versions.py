@@ -2,10 +2,14 @@
 import os
 import sys
 import json
+import hashlib
+import gzip
 import re
 import urllib.request
 import urllib.error
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration
 GRAMINE_DEFAULT_OWNER = "gramineproject"
@@ -21,30 +25,115 @@ CI_JOB_TOKEN = os.environ.get("CI_JOB_TOKEN")
 CI_COMMIT_SHA = os.environ.get("CI_COMMIT_SHA")
 CI_COMMIT_BEFORE_SHA = os.environ.get("CI_COMMIT_BEFORE_SHA")
 CI_PIPELINE_SOURCE = os.environ.get("CI_PIPELINE_SOURCE")
+CI_PROJECT_DIR = os.environ.get("CI_PROJECT_DIR", ".")
+
+# Conditional-request cache for upstream metadata (persisted via GitLab CI cache)
+HTTP_CACHE_DIR = os.path.join(CI_PROJECT_DIR, ".cache", "http")
 
 # Inputs (from environment variables in GitLab)
 FORCE_REBUILD = os.environ.get("FORCE_REBUILD", "false").lower() == "true"
 INPUT_GRAMINE_REF = os.environ.get("GRAMINE_REF", "")
 INPUT_GRAMINE_OWNER = os.environ.get("GRAMINE_OWNER", "auto")
 
+# Tag patterns (compiled once at import). Both are fully anchored, so
+# pre-release tags such as openssl-3.5.0-beta1 or v23.0.0-rc.1 never match.
+OPENSSL_TAG_RE = re.compile(r"^openssl-(\d+)\.(\d+)\.(\d+)([a-z])?$")
+NODE_TAG_RE = re.compile(r"^v(\d+)\.(\d+)\.(\d+)$")
+
+# Input validation for values interpolated into API URLs. As with git's
+# check-ref-format, refs may not contain ".." or have a component starting
+# with "." (which also rules out "." and ".." path segments).
+GH_OWNER_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,38}$")
+GH_REF_RE = re.compile(r"^(?!.*\.\.)(?!(?:.*/)?\.)[A-Za-z0-9._/-]{1,255}$")
+# A single GitLab package registry path segment (name, version or file name)
+PKG_SEGMENT_RE = re.compile(r"^(?!.*\.\.)(?!\.)[A-Za-z0-9._-]{1,255}$")
+
+# Serializes log output from the worker threads in main()
+_log_lock = threading.Lock()
+
 def log(msg):
-    print(f"[CHECK-VERSIONS] {msg}", file=sys.stderr)
+    with _log_lock:
+        print(f"[CHECK-VERSIONS] {msg}", file=sys.stderr)
+
+HTTP_TIMEOUT = 30
+# GitHub rejects API requests without a User-Agent
+HTTP_USER_AGENT = "python-urllib/check-versions"
+
+# Perform a request and return (status, headers, body). HTTP error statuses are
+# returned rather than raised; network failures still raise. urlopen keeps the
+# default proxy handling (https_proxy/no_proxy) and redirect following.
+def http_request(url, headers=None, method="GET"):
+    req = urllib.request.Request(url, headers=headers or {}, method=method)
+    req.add_header("User-Agent", HTTP_USER_AGENT)
+    req.add_header("Accept-Encoding", "gzip")
+    try:
+        with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as response:
+            status, resp_headers, body = response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, b""
+    if resp_headers.get("Content-Encoding") == "gzip":
+        body = gzip.decompress(body)
+    return status, resp_headers, body
+
+def _http_cache_paths(url):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    base = os.path.join(HTTP_CACHE_DIR, key)
+    return f"{base}.json", f"{base}.meta"
+
+# GET url and return (status, body). A previously stored ETag/Last-Modified is
+# sent as If-None-Match/If-Modified-Since and a 304 reply reuses the cached
+# body (reported as 200).
+def cached_get(url, headers=None):
+    headers = dict(headers or {})
+    body_path, meta_path = _http_cache_paths(url)
+    cached_body = None
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            cached_body = f.read()
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    except (OSError, ValueError):
+        cached_body = None
+
+    status, resp_headers, body = http_request(url, headers)
+    if status == 304 and cached_body is not None:
+        return 200, cached_body
+    if status != 200:
+        return status, body
+
+    etag = resp_headers.get("ETag")
+    last_modified = resp_headers.get("Last-Modified")
+    if etag or last_modified:
+        # Write to temp files and rename so concurrent readers never see a
+        # partially written entry
+        try:
+            os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+            with open(f"{body_path}.tmp", "wb") as f:
+                f.write(body)
+            with open(f"{meta_path}.tmp", "w") as f:
+                json.dump({"url": url, "etag": etag, "last_modified": last_modified}, f)
+            os.replace(f"{body_path}.tmp", body_path)
+            os.replace(f"{meta_path}.tmp", meta_path)
+        except OSError as e:
+            log(f"Warning: failed to cache {url}: {e}")
+    return status, body
 
 def github_api_get(path):
     url = f"https://api.github.com/{path}"
-    req = urllib.request.Request(url)
-    # Add User-Agent to avoid rate limiting or rejection
-    req.add_header("User-Agent", "python-urllib/check-versions")
+    headers = {}
     # Optional: Add GitHub Token if provided in env for higher rate limits
     if os.environ.get("GITHUB_TOKEN"):
-        req.add_header("Authorization", f"Bearer {os.environ.get('GITHUB_TOKEN')}")
+        headers["Authorization"] = f"Bearer {os.environ.get('GITHUB_TOKEN')}"
     
-    try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        log(f"GitHub API error for {url}: {e}")
+    status, body = cached_get(url, headers)
+    if status != 200:
+        log(f"GitHub API error for {url}: HTTP {status}")
         return None
+    return json.loads(body.decode())
 
 def gitlab_api_get(path):
     if not CI_PROJECT_ID or not CI_JOB_TOKEN:
@@ -52,23 +141,24 @@ def gitlab_api_get(path):
         return None
         
     url = f"{CI_API_V4_URL}/projects/{CI_PROJECT_ID}/{path}"
-    req = urllib.request.Request(url)
-    req.add_header("JOB-TOKEN", CI_JOB_TOKEN)
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        if e.code != 404:
-            log(f"GitLab API error for {url}: {e}")
+    status, _, body = http_request(url, {"JOB-TOKEN": CI_JOB_TOKEN})
+    if status != 200:
+        if status != 404:
+            log(f"GitLab API error for {url}: HTTP {status}")
         return None
+    return json.loads(body.decode())
 
-def read_version_file(path):
-    try:
-        with open(path, "r") as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        return ""
+# Return the contents of the first non-empty file among paths
+def read_version_file(*paths):
+    for path in paths:
+        try:
+            with open(path, "r") as f:
+                value = f.read().strip()
+        except FileNotFoundError:
+            continue
+        if value:
+            return value
+    return ""
 
 def check_package_exists(package_name, package_version, filename):
     # Check GitLab Generic Package Registry
@@ -79,75 +169,86 @@ def check_package_exists(package_name, package_version, filename):
     if not CI_PROJECT_ID or not CI_JOB_TOKEN:
         return False
 
+    for part in (package_name, package_version, filename):
+        if not part or not PKG_SEGMENT_RE.match(part):
+            log(f"Invalid package coordinate: {part!r}")
+            return False
+
     url = f"{CI_API_V4_URL}/projects/{CI_PROJECT_ID}/packages/generic/{package_name}/{package_version}/{filename}"
-    req = urllib.request.Request(url, method="HEAD")
-    req.add_header("JOB-TOKEN", CI_JOB_TOKEN)
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            return response.status == 200
-    except urllib.error.HTTPError:
-        return False
+    status, _, _ = http_request(url, {"JOB-TOKEN": CI_JOB_TOKEN}, method="HEAD")
+    return status == 200
 
 # --- OpenSSL Logic ---
 def parse_openssl_tag(name):
     # Matches: openssl-3.0.14 or openssl-1.1.1w
-    m = re.match(r"^openssl-(\d+)\.(\d+)\.(\d+)([a-z])?$", name)
+    m = OPENSSL_TAG_RE.match(name)
     if not m:
         return None
-    major, minor, patch = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    # Sort key: (major, minor, patch, letter)
     letter = ord(m.group(4)) if m.group(4) else 0
-    return {"name": name, "major": major, "minor": minor, "patch": patch, "letter": letter}
+    return (int(m.group(1)), int(m.group(2)), int(m.group(3)), letter)
 
 def get_latest_openssl():
-    tags = github_api_get(f"repos/{OPENSSL_REPO}/tags?per_page=100")
-    if not tags:
-        return None
+    # matching-refs returns every openssl-* tag (any major, as the GitHub
+    # workflow considers) in one response, skipping the legacy OpenSSL_*
+    # tags that make up much of the full tag list
+    refs = github_api_get(f"repos/{OPENSSL_REPO}/git/matching-refs/tags/openssl-")
+    if refs:
+        names = [r["ref"][len("refs/tags/"):] for r in refs]
+    else:
+        # Fall back to paging through all tags, like the GitHub workflow
+        names = []
+        page = 1
+        while True:
+            tags = github_api_get(f"repos/{OPENSSL_REPO}/tags?per_page=100&page={page}")
+            if not tags:
+                break
+            names.extend(t["name"] for t in tags)
+            if len(tags) < 100:
+                break
+            page += 1
     
-    candidates = []
-    for t in tags:
-        name = t["name"]
-        if re.search(r"-(alpha|beta|pre|rc)", name, re.IGNORECASE):
-            continue
-        parsed = parse_openssl_tag(name)
-        if parsed:
-            candidates.append(parsed)
-            
-    if not candidates:
-        return None
-        
-    # Sort: Major DESC, Minor DESC, Patch DESC, Letter DESC
-    candidates.sort(key=lambda x: (x["major"], x["minor"], x["patch"], x["letter"]), reverse=True)
-    return candidates[0]["name"]
+    # Both sources go through the same parse/filter: keep the highest
+    # (major, minor, patch, letter) seen in a single pass
+    best, best_key = None, None
+    for name in names:
+        key = parse_openssl_tag(name)
+        if key and (best_key is None or key > best_key):
+            best, best_key = name, key
+
+    return best
 
 # --- Node.js Logic ---
 def parse_node_tag(name):
-    m = re.match(r"^v(\d+)\.(\d+)\.(\d+)$", name)
+    m = NODE_TAG_RE.match(name)
     if not m:
         return None
-    return {"name": name, "major": int(m.group(1)), "minor": int(m.group(2)), "patch": int(m.group(3))}
+    # Sort key: (major, minor, patch)
+    return (int(m.group(1)), int(m.group(2)), int(m.group(3)))
 
 def get_latest_node_lts():
     max_major = 22 # GCC 11 compatibility
     
     try:
-        with urllib.request.urlopen(NODEJS_DIST_URL) as response:
-            releases = json.loads(response.read().decode())
+        status, body = cached_get(NODEJS_DIST_URL)
+        if status != 200:
+            log(f"Failed to fetch Node.js dist: HTTP {status}")
+            return None
+        releases = json.loads(body.decode())
             
-        candidates = []
+        best, best_key = None, None
         for r in releases:
             if not r.get("lts"): continue
-            if re.search(r"-(rc|beta|alpha|nightly)", r["version"], re.IGNORECASE): continue
             
-            parsed = parse_node_tag(r["version"])
-            if parsed and parsed["major"] <= max_major:
-                candidates.append(parsed)
+            key = parse_node_tag(r["version"])
+            if key and key[0] <= max_major and (best_key is None or key > best_key):
+                best, best_key = r["version"], key
+                # The index is newest-first, so the first LTS seen on the
+                # newest allowed major line is also its highest release
+                if key[0] == max_major:
+                    break
                 
-        if not candidates:
-            return None
-            
-        candidates.sort(key=lambda x: (x["major"], x["minor"], x["patch"]), reverse=True)
-        return candidates[0]["name"]
+        return best
         
     except Exception as e:
         log(f"Failed to fetch Node.js dist: {e}")
@@ -166,17 +267,23 @@ def get_gramine_owner():
     return "mccoysc" # Default to mccoysc as per GHA logic fallback
 
 def get_latest_gramine(owner, ref):
+    # Reject malformed inputs up front instead of spending a round-trip on a 404
+    if not GH_OWNER_RE.match(owner):
+        log(f"Invalid Gramine owner: {owner!r}")
+        return None
+    if ref and not GH_REF_RE.match(ref):
+        log(f"Invalid Gramine ref: {ref!r}")
+        return None
+
     if ref:
         commit = github_api_get(f"repos/{owner}/{GRAMINE_REPO}/commits/{ref}")
         if commit:
             return commit["sha"]
     else:
-        repo = github_api_get(f"repos/{owner}/{GRAMINE_REPO}")
-        if repo:
-            default_branch = repo["default_branch"]
-            commit = github_api_get(f"repos/{owner}/{GRAMINE_REPO}/commits/{default_branch}")
-            if commit:
-                return commit["sha"]
+        # Without a sha parameter the commit list starts at the default branch head
+        commits = github_api_get(f"repos/{owner}/{GRAMINE_REPO}/commits?per_page=1")
+        if commits:
+            return commits[0]["sha"]
     return None
 
 # --- Dockerfile Change Logic ---
@@ -188,97 +295,114 @@ def check_dockerfile_changed():
     
     # Use git diff if available
     if CI_COMMIT_BEFORE_SHA and CI_COMMIT_BEFORE_SHA != "0000000000000000000000000000000000000000":
-        try:
-            cmd = ["git", "diff", "--name-only", CI_COMMIT_BEFORE_SHA, CI_COMMIT_SHA]
-            output = subprocess.check_output(cmd).decode()
-            for line in output.splitlines():
-                if line == "Dockerfile" or line.startswith("scripts/") or line.startswith("config/"):
-                    return True
-        except subprocess.CalledProcessError:
-            pass
+        # Let git filter by pathspec: --quiet exits 1 when something under
+        # these paths changed, 0 when not, and >1 on error (treated as unchanged)
+        cmd = ["git", "diff", "--quiet", CI_COMMIT_BEFORE_SHA, CI_COMMIT_SHA, "--", "Dockerfile", "scripts/", "config/"]
+        if subprocess.call(cmd, stdout=subprocess.DEVNULL) == 1:
+            return True
             
     return False
 
 def main():
-    # 1. Gramine
     gramine_owner = get_gramine_owner()
-    latest_gramine_sha = get_latest_gramine(gramine_owner, INPUT_GRAMINE_REF)
-    if not latest_gramine_sha:
-        log("Failed to resolve Gramine SHA")
-        sys.exit(1)
-        
-    latest_gramine_sha_short = latest_gramine_sha[:8]
-    current_gramine_sha = read_version_file("prebuilt/gramine/VERSION") or read_version_file(".gramine-version")
-    
-    gramine_changed = latest_gramine_sha != current_gramine_sha
-    gramine_pkg_name = "gramine"
-    gramine_pkg_version = latest_gramine_sha_short
-    gramine_filename = f"gramine-install-{latest_gramine_sha_short}.tar.gz"
-    gramine_exists = check_package_exists(gramine_pkg_name, gramine_pkg_version, gramine_filename)
-    
+
+    # All lookups are network-bound, so run them concurrently: first the
+    # upstream version queries, then the registry checks that need the
+    # resolved versions.
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        gramine_future = pool.submit(get_latest_gramine, gramine_owner, INPUT_GRAMINE_REF)
+        openssl_future = pool.submit(get_latest_openssl)
+        node_future = pool.submit(get_latest_node_lts)
+        dockerfile_future = pool.submit(check_dockerfile_changed)
+
+        # 1. Gramine
+        latest_gramine_sha = gramine_future.result()
+        if not latest_gramine_sha:
+            log("Failed to resolve Gramine SHA")
+            # Don't wait for the other lookups: drop queued work and skip the
+            # interpreter's join of still-running executor threads
+            pool.shutdown(wait=False, cancel_futures=True)
+            sys.stderr.flush()
+            os._exit(1)
+
+        latest_gramine_sha_short = latest_gramine_sha[:8]
+        current_gramine_sha = read_version_file("prebuilt/gramine/VERSION", ".gramine-version")
+
+        gramine_changed = latest_gramine_sha != current_gramine_sha
+        gramine_pkg_name = "gramine"
+        gramine_pkg_version = latest_gramine_sha_short
+        gramine_filename = f"gramine-install-{latest_gramine_sha_short}.tar.gz"
+        gramine_exists_future = pool.submit(check_package_exists, gramine_pkg_name, gramine_pkg_version, gramine_filename)
+
+        # 2. OpenSSL
+        latest_openssl = openssl_future.result()
+        current_openssl = read_version_file("prebuilt/openssl/VERSION")
+
+        openssl_changed = latest_openssl != current_openssl
+        openssl_pkg_name = "openssl"
+        openssl_pkg_version = latest_openssl
+        openssl_filename = f"openssl-install-{latest_openssl}.tar.gz"
+        openssl_exists_future = pool.submit(check_package_exists, openssl_pkg_name, openssl_pkg_version, openssl_filename)
+
+        # 3. Node.js
+        latest_node = node_future.result()
+        current_node = read_version_file("prebuilt/nodejs/VERSION")
+
+        node_changed = latest_node != current_node
+        node_pkg_name = "nodejs"
+        node_pkg_version = latest_node
+        node_filename = f"node-install-{latest_node}.tar.gz"
+        node_exists_future = pool.submit(check_package_exists, node_pkg_name, node_pkg_version, node_filename)
+
+        gramine_exists = gramine_exists_future.result()
+        openssl_exists = openssl_exists_future.result()
+        node_exists = node_exists_future.result()
+        dockerfile_changed = dockerfile_future.result()
+
     needs_gramine = FORCE_REBUILD or gramine_changed or (INPUT_GRAMINE_REF != "") or not gramine_exists
-    
     log(f"Gramine: latest={latest_gramine_sha_short}, exists={gramine_exists}, needs_build={needs_gramine}")
 
-    # 2. OpenSSL
-    latest_openssl = get_latest_openssl()
-    current_openssl = read_version_file("prebuilt/openssl/VERSION")
-    
-    openssl_changed = latest_openssl != current_openssl
-    openssl_pkg_name = "openssl"
-    openssl_pkg_version = latest_openssl
-    openssl_filename = f"openssl-install-{latest_openssl}.tar.gz"
-    openssl_exists = check_package_exists(openssl_pkg_name, openssl_pkg_version, openssl_filename)
-    
     needs_openssl = FORCE_REBUILD or openssl_changed or not openssl_exists
-    
     log(f"OpenSSL: latest={latest_openssl}, exists={openssl_exists}, needs_build={needs_openssl}")
 
-    # 3. Node.js
-    latest_node = get_latest_node_lts()
-    current_node = read_version_file("prebuilt/nodejs/VERSION")
-    
-    node_changed = latest_node != current_node
-    node_pkg_name = "nodejs"
-    node_pkg_version = latest_node
-    node_filename = f"node-install-{latest_node}.tar.gz"
-    node_exists = check_package_exists(node_pkg_name, node_pkg_version, node_filename)
-    
     needs_node = FORCE_REBUILD or node_changed or not node_exists
-    
     log(f"Node.js: latest={latest_node}, exists={node_exists}, needs_build={needs_node}")
 
     # 4. Docker Image
-    dockerfile_changed = check_dockerfile_changed()
     needs_image = dockerfile_changed or gramine_changed or openssl_changed or node_changed
-    
     log(f"Image: needs_build={needs_image} (dockerfile={dockerfile_changed})")
 
-    # Output to build.env
-    with open("build.env", "w") as f:
-        f.write(f"NEEDS_GRAMINE={str(needs_gramine).lower()}\n")
-        f.write(f"NEEDS_OPENSSL={str(needs_openssl).lower()}\n")
-        f.write(f"NEEDS_NODE={str(needs_node).lower()}\n")
-        f.write(f"NEEDS_IMAGE={str(needs_image).lower()}\n")
-        
-        f.write(f"GRAMINE_OWNER={gramine_owner}\n")
-        f.write(f"GRAMINE_SHA={latest_gramine_sha}\n")
-        f.write(f"GRAMINE_SHA_SHORT={latest_gramine_sha_short}\n")
-        f.write(f"OPENSSL_VERSION={latest_openssl}\n")
-        f.write(f"NODE_VERSION={latest_node}\n")
-        
+    outputs = [
+        ("NEEDS_GRAMINE", str(needs_gramine).lower()),
+        ("NEEDS_OPENSSL", str(needs_openssl).lower()),
+        ("NEEDS_NODE", str(needs_node).lower()),
+        ("NEEDS_IMAGE", str(needs_image).lower()),
+
+        ("GRAMINE_OWNER", gramine_owner),
+        ("GRAMINE_SHA", latest_gramine_sha),
+        ("GRAMINE_SHA_SHORT", latest_gramine_sha_short),
+        ("OPENSSL_VERSION", latest_openssl),
+        ("NODE_VERSION", latest_node),
+
         # Package Registry Helpers
-        f.write(f"GRAMINE_PKG_NAME={gramine_pkg_name}\n")
-        f.write(f"GRAMINE_PKG_VERSION={gramine_pkg_version}\n")
-        f.write(f"GRAMINE_FILENAME={gramine_filename}\n")
-        
-        f.write(f"OPENSSL_PKG_NAME={openssl_pkg_name}\n")
-        f.write(f"OPENSSL_PKG_VERSION={openssl_pkg_version}\n")
-        f.write(f"OPENSSL_FILENAME={openssl_filename}\n")
-        
-        f.write(f"NODE_PKG_NAME={node_pkg_name}\n")
-        f.write(f"NODE_PKG_VERSION={node_pkg_version}\n")
-        f.write(f"NODE_FILENAME={node_filename}\n")
+        ("GRAMINE_PKG_NAME", gramine_pkg_name),
+        ("GRAMINE_PKG_VERSION", gramine_pkg_version),
+        ("GRAMINE_FILENAME", gramine_filename),
+
+        ("OPENSSL_PKG_NAME", openssl_pkg_name),
+        ("OPENSSL_PKG_VERSION", openssl_pkg_version),
+        ("OPENSSL_FILENAME", openssl_filename),
+
+        ("NODE_PKG_NAME", node_pkg_name),
+        ("NODE_PKG_VERSION", node_pkg_version),
+        ("NODE_FILENAME", node_filename),
+    ]
+
+    # Output to build.env in one write, published atomically via rename so
+    # downstream jobs never see a partial file
+    with open("build.env.tmp", "w") as f:
+        f.write("".join(f"{key}={value}\n" for key, value in outputs))
+    os.replace("build.env.tmp", "build.env")
 
 if __name__ == "__main__":
     main()